@@ -27,11 +27,10 @@ setup(
     packages=find_packages(),
     install_requires=[
         'aiohttp',
-        'colorlog',
+        'cbor',
         'protobuf',
         'sawtooth-sdk',
         'sawtooth-signing',
-        'PyYAML',
     ],
     data_files=[],
     entry_points={
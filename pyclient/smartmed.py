@@ -21,63 +21,163 @@ to process.
 '''
 
 import argparse
-from datetime import date
+import atexit
+import functools
 import logging
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+import mmap
 import os
+import queue
+import shlex
 import sys
 
-import traceback
-import random
 import time
-import datetime
-from multiprocessing import Process
+import multiprocessing
+from collections import deque
 
-from colorlog import ColoredFormatter
-from smartmed_client import smartmedClient
+LOGGER = logging.getLogger(__name__)
+
+# Background thread writing queued log records; started by setup_loggers.
+_LOG_LISTENER = None
+
+# Program name shown in usage messages; sys.argv[0] never changes.
+_PROG = os.path.basename(sys.argv[0])
 
 KEY_NAME = 'mysmartmed'
 
-out_time = datetime.datetime.now()
+# Command files larger than this (in bytes) are read through mmap.
+MMAP_THRESHOLD = 1024 * 1024
+
+# Upper bound on auto_run batch POSTs submitted but not yet finished.
+AUTO_RUN_MAX_INFLIGHT = 64
+
+# auto_run replies 'yes' to this project as DS00000001, DS00000002, ...
+AUTO_RUN_PROJECT = 'PR11111112'
+
+out_time = time.perf_counter()
+
+# Directory holding the Sawtooth private keys, resolved once at import.
+_KEY_DIR = os.path.join(os.path.expanduser("~"), ".sawtooth", "keys")
+
+# Number of auto_run replies sent to the REST API in one BatchList POST.
+AUTO_RUN_BATCH_SIZE = 50
 
 # hard-coded for simplicity (otherwise get the URL from the args in main):
 DEFAULT_URL = 'http://localhost:8008'
 # For Docker:
 # DEFAULT_URL = 'http://rest-api:8008'
 
+class _AnsiFormatter(logging.Formatter):
+    '''Colored console formatter with the per-level escapes prebuilt.
+
+       Produces the same layout the CLI used with colorlog, but the color
+       prefix is a dict lookup and the line is one concatenation, so no
+       format template is parsed per record.
+    '''
+    _RESET = '\x1b[0m'
+    _WHITE = '\x1b[37m'
+    _COLORS = {
+        logging.DEBUG: '\x1b[36m',
+        logging.INFO: '\x1b[32m',
+        logging.WARNING: '\x1b[33m',
+        logging.ERROR: '\x1b[31m',
+        logging.CRITICAL: '\x1b[31m',
+    }
+
+    def __init__(self):
+        super().__init__(datefmt="%H:%M:%S")
+        self._prefix = {
+            level: (color, '{:<8}'.format(logging.getLevelName(level)))
+            for level, color in self._COLORS.items()
+        }
+
+    def format(self, record):
+        color, level = self._prefix.get(
+            record.levelno, ('', '{:<8}'.format(record.levelname)))
+        line = color + '[' + self.formatTime(record, self.datefmt) + ' ' + \
+            level + record.module + ']' + self._RESET + ' ' + \
+            self._WHITE + record.getMessage() + self._RESET
+        if record.exc_info:
+            line = line + '\n' + self.formatException(record.exc_info)
+        return line
+
 def create_console_handler(verbose_level):
-    '''Setup console logging.'''
-    del verbose_level # unused
+    '''Setup console logging.
+
+       Colors are only used when stderr is a terminal and NO_COLOR is not set.
+    '''
     clog = logging.StreamHandler()
-    formatter = ColoredFormatter(
-        "%(log_color)s[%(asctime)s %(levelname)-8s%(module)s]%(reset)s "
-        "%(white)s%(message)s",
-        datefmt="%H:%M:%S",
-        reset=True,
-        log_colors={
-            'DEBUG': 'cyan',
-            'INFO': 'green',
-            'WARNING': 'yellow',
-            'ERROR': 'red',
-            'CRITICAL': 'red',
-        })
+    if os.environ.get('NO_COLOR') is None and sys.stderr.isatty():
+        formatter = _AnsiFormatter()
+    else:
+        formatter = logging.Formatter(
+            "[%(asctime)s %(levelname)-8s%(module)s] %(message)s",
+            datefmt="%H:%M:%S")
 
     clog.setFormatter(formatter)
-    clog.setLevel(logging.DEBUG)
+    clog.setLevel(_verbose_to_level(verbose_level))
     return clog
 
+def _verbose_to_level(verbose_level):
+    '''Map the -v count to a logging level: 0=WARNING, 1=INFO, 2+=DEBUG.'''
+    if verbose_level <= 0:
+        return logging.WARNING
+    if verbose_level == 1:
+        return logging.INFO
+    return logging.DEBUG
+
 def setup_loggers(verbose_level):
-    '''Setup logging.'''
+    '''Setup logging.
+
+       Records below the -v level are dropped by the root logger before any
+       formatting. The rest are handed to a QueueHandler, and a background
+       QueueListener formats and writes them to stderr, so logging calls
+       never block on the console.
+    '''
+    global _LOG_LISTENER
+    level = _verbose_to_level(verbose_level)
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(create_console_handler(verbose_level))
-
-def create_parser(prog_name):
+    logger.setLevel(level)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    _LOG_LISTENER = QueueListener(log_queue,
+                                  create_console_handler(verbose_level),
+                                  respect_handler_level=True)
+    _LOG_LISTENER.start()
+    atexit.register(_LOG_LISTENER.stop)
+
+def _init_worker():
+    '''Log straight to the console in auto_run pool workers.
+
+       The listener thread only runs in the parent process, so a forked
+       worker would otherwise queue records that nobody writes out. The
+       worker gets new handlers rather than the listener's: the fork may
+       happen mid-write, and their locks are not reset in the child.
+    '''
+    if _LOG_LISTENER is None:
+        return
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    for handler in _LOG_LISTENER.handlers:
+        fresh = logging.StreamHandler()
+        fresh.setFormatter(handler.formatter)
+        fresh.setLevel(handler.level)
+        logger.addHandler(fresh)
+
+def _build_parser(prog_name):
     '''Create the command line argument parser for the smartmed CLI.'''
     parent_parser = argparse.ArgumentParser(prog=prog_name, add_help=False)
 
     parser = argparse.ArgumentParser(
         description='Provides subcommands to manage your queries',
         parents=[parent_parser])
+    parser.add_argument('-v', '--verbose',
+                        action='count',
+                        default=0,
+                        help='enable more verbose output (-v INFO, -vv DEBUG)')
 
     subparsers = parser.add_subparsers(title='subcommands', dest='command')
     subparsers.required = True
@@ -206,18 +306,127 @@ def create_parser(prog_name):
                                type=str,
                                help='Path to the file to be executed')
 
+    # Every subcommand dispatches through args.func; a subcommand without
+    # an entry in DISPATCH fails here, when the parser is built.
+    for command, subparser in subparsers.choices.items():
+        subparser.set_defaults(func=DISPATCH[command])
+
     return parser
 
+@functools.lru_cache(maxsize=1)
+def get_parser(prog_name):
+    '''Return the smartmed CLI parser, building it only on first use.
+
+       The file and auto_run modes parse one command per line/transaction,
+       so the parser is built once and reused for every parse.
+    '''
+    return _build_parser(prog_name)
+
+# Flat description of the subcommands for parse_command's fast path:
+# command -> (positional names, {option name: type}). It must describe the
+# same arguments as _build_parser, which stays the reference parser.
+COMMAND_SPEC = {
+    'register': (('projectID',),
+                 {'feasibility': str, 'ethicality': str,
+                  'approved_time': str, 'validity_duration': str,
+                  'legal_base': str, 'DS_selection_criteria': str,
+                  'project_issuer': str}),
+    'request': (('projectID',), {'username': str}),
+    'reply': (('projectID', 'consent'), {'username': str}),
+    'find': (('color',), {'qid': int}),
+    'list': ((), {}),
+    'showDS': (('projectID', 'DS'), {}),
+    'showPR': (('projectID',), {}),
+    'interested': (('status',),
+                   {'username': str, 'qid': int, 'incoming_tps': int}),
+    'auto_run': ((), {}),
+    'delete': (('projectID',), {}),
+    'deleteDS': (('projectID', 'DS'), {}),
+    'file': (('filepath',), {}),
+}
+
+def _args_class(command, positional_names, options):
+    '''Build a slotted argument record for one COMMAND_SPEC entry.'''
+    slots = ('verbose', 'command', 'func') + \
+        tuple(positional_names) + tuple(options)
+    return type(command + 'Args', (), {'__slots__': slots})
+
+# Arguments parsed on the fast path are stored in these slotted records
+# rather than in an argparse.Namespace backed by a per-instance dict.
+_ARGS_CLASSES = {command: _args_class(command, *spec)
+                 for command, spec in COMMAND_SPEC.items()}
+
+def _fast_parse(argv):
+    '''Parse a well-formed command line without argparse.
+
+       Return None for anything outside the plain "command positionals
+       --option value" shape (help, -v, abbreviations, bad values...) so
+       that the caller falls back to the full parser and its messages.
+    '''
+    if not argv or argv[0] not in COMMAND_SPEC:
+        return None
+    positional_names, options = COMMAND_SPEC[argv[0]]
+    args = _ARGS_CLASSES[argv[0]]()
+    args.verbose = 0
+    args.command = argv[0]
+    args.func = DISPATCH[argv[0]]
+    for name in options:
+        setattr(args, name, None)
+    positionals = []
+    tokens = iter(argv[1:])
+    for token in tokens:
+        if not token.startswith('-'):
+            positionals.append(token)
+            continue
+        name = token[2:]
+        value = next(tokens, None)
+        if not token.startswith('--') or name not in options \
+                or value is None or value.startswith('-'):
+            return None
+        try:
+            setattr(args, name, options[name](value))
+        except ValueError:
+            return None
+    if len(positionals) != len(positional_names):
+        return None
+    for name, value in zip(positional_names, positionals):
+        setattr(args, name, value)
+    return args
+
+def parse_command(argv, prog_name=_PROG):
+    '''Parse a CLI argument list into a Namespace for function_dispatcher.'''
+    args = _fast_parse(argv)
+    if args is None:
+        args = get_parser(prog_name).parse_args(argv)
+    return args
+
+@functools.lru_cache(maxsize=None)
 def _get_private_keyfile(key_name):
     '''Get the private key for key_name.'''
-    home = os.path.expanduser("~")
-    key_dir = os.path.join(home, ".sawtooth", "keys")
-    return '{}/{}.priv'.format(key_dir, key_name)
+    return os.path.join(_KEY_DIR, key_name + '.priv')
+
+def _new_client(base_url, key_file):
+    '''Create a smartmedClient for key_file.
+
+       smartmed_client (and the Sawtooth SDK under it) is imported here so
+       that --help and argument errors do not pay for loading it.
+    '''
+    from smartmed_client import smartmedClient
+    return smartmedClient(base_url=base_url, key_file=key_file)
+
+@functools.lru_cache(maxsize=None)
+def _get_client(base_url, key_file):
+    '''Return a smartmedClient for key_file, creating it only once.
+
+       The client holds the parsed signer and a keep-alive HTTP session,
+       so reusing it avoids re-reading the key and reconnecting per command.
+    '''
+    return _new_client(base_url, key_file)
 
 def do_register(args):
     '''Subcommand to populate the ledger with the projects. Calls client class to do the registering.'''
     privkeyfile = _get_private_keyfile(args.project_issuer)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.register(args.projectID, args.feasibility, args.ethicality, args.approved_time, args.validity_duration,
     args.legal_base, args.DS_selection_criteria, args.project_issuer)
     print("Find Response: {}".format(response))
@@ -226,225 +435,238 @@ def do_register(args):
 def do_request(args):
     '''Subcommand to request a project based on projectID. Calls client class to do the requesting.'''
     privkeyfile = _get_private_keyfile(args.username)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.request(args.projectID, args.username)
     print("Find Response: {}".format(response))
 
 def do_reply(args):
     '''Subcommand to replying to consent. Calls client class to do the replying.'''
     privkeyfile = _get_private_keyfile(args.username)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.reply(args.projectID, args.username, args.consent)
     print("Find Response: {}".format(response))            
 
 def do_find(args):
     '''Subcommand to find a list of DSs with associated color. Calls client class to do the finding.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.find(args.color,args.qid)
     print("Find Response: {}".format(response))
 
 def do_interested(args):
     '''Subcommand to show the interest of the DS to a query. Calls client class to do the interest.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     data = client.get_query(args.qid)
-    if data is not None:
-        qid, ds1, ds2, ds3, ds4, ds5 = data.decode().split(",")
+    if data is None:
+        print("Query {} not found".format(args.qid))
+        return
+    qid, ds1, ds2, ds3, ds4, ds5 = data
     response = client.interested(args.username,args.qid,args.status,ds1,ds2,ds3,ds4,ds5)
-    print("Find Response: {}".format(response))    
+    print("Find Response: {}".format(response))
+
+_LIST_ROW = ("{} ) Project ID:{} | Feasibility:{} | Ethicality:{}"
+             " | Approved time:{} | Validity duration:{} | Legal base:{}"
+             " | DS selection criteria:{} | Project issuer:{}"
+             " | HD transfer proof:{} | Consent reply:{}")
+_PROJECT_FIELDS = 10
 
-def do_list():
+def do_list(args):
     '''Subcommand to show the list of query results.  Calls client class to do the showing.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    query_list = [
-        tx.split(',')
-        for txs in client.list()
-        for tx in txs.decode().split('|')
-    ]
-    if query_list is not None:
-        count = 0;
-        for tx_data in query_list:
-            count = count + 1
-    #        qid, ds1, ds2, ds3, ds4, ds5 = tx_data
-            projectID,feasibility,ethicality,approved_time,validity_duration,legal_base, \
-                DS_selection_criteria,project_issuer,HD_trasfer_proof,*consent_reply = tx_data
-            print(count, ") Project ID:"+ projectID, \
-                "| Feasibility:"+ feasibility, \
-                "| Ethicality:"+ ethicality, \
-                "| Approved time:"+ approved_time, \
-                "| Validity duration:"+ validity_duration, \
-                "| Legal base:"+ legal_base, \
-                "| DS selection criteria:"+ DS_selection_criteria, \
-                "| Project issuer:"+ project_issuer, \
-                "| HD transfer proof:"+ HD_trasfer_proof, \
-                "| Consent reply:"+ str(consent_reply)     )
-    else:
-        raise Exception("Transaction data not found")
+    client = _get_client(DEFAULT_URL, privkeyfile)
+    sys.stdout.writelines(_list_rows(client.list()))
+
+def _list_rows(entries):
+    '''Yield one formatted do_list line per project in the state entries.
+
+       Entries are formatted one at a time as the output is written, so no
+       list of all projects is built. Query results written by "find" share
+       the namespace but are not projects, and are skipped.
+    '''
+    count = 0
+    for entry in entries:
+        if len(entry) != _PROJECT_FIELDS:
+            continue
+        count += 1
+        yield _LIST_ROW.format(count, *entry) + '\n'
+
+def _print_consents(entries):
+    '''Print (projectID, DS, consent) state entries returned by showDS/showPR.'''
+    for projectID, DS, consent_reply in entries:
+        print("Project ID:"+ projectID, \
+            "| DS:"+ DS, \
+            "| Consent reply:"+ consent_reply)
 
 def do_showDS(args):
     '''Subcommand to show the status of the given DS for a given project. Calls client class to do the showing.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    query_list = [
-        tx.split(',')
-        for txs in client.showDS(args.projectID, args.DS)
-        for tx in txs.decode().split('|')
-    ]
-    if query_list is not None:
-    #    count = 0;
-        for tx_data in query_list:
-    #        count = count + 1
-    #        qid, ds1, ds2, ds3, ds4, ds5 = tx_data
-            projectID, DS, consent_reply = tx_data
-            print("Project ID:"+ projectID, \
-                "| DS:"+ DS, \
-                "| Consent reply:"+ consent_reply)
-    else:
-        raise Exception("Transaction data not found")
+    client = _get_client(DEFAULT_URL, privkeyfile)
+    _print_consents(client.showDS(args.projectID, args.DS))
 
 def do_showPR(args):
     '''Subcommand to show the consent status of the given project. Calls client class to do the showing.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
-    query_list = [
-        tx.split(',')
-        for txs in client.showPR(args.projectID)
-        for tx in txs.decode().split('|')
-    ]
-    if query_list is not None:
-        for tx_data in query_list:
-            projectID, DS, consent_reply = tx_data
-            print("Project ID:"+ projectID, \
-                "| DS:"+ DS, \
-                "| Consent reply:"+ consent_reply)
-    else:
-        raise Exception("Transaction data not found")                              
+    client = _get_client(DEFAULT_URL, privkeyfile)
+    _print_consents(client.showPR(args.projectID))
 
 def do_delete(args):
     '''Subcommand to delete a query.  Calls client class to do the deleting.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.delete(args.projectID)
     print("delete Response: {}".format(response))
 
 def do_deleteDS(args):
     '''Subcommand to delete all DSs for a project query. Calls client class to do the deleting.'''
     privkeyfile = _get_private_keyfile(KEY_NAME)
-    client = smartmedClient(base_url=DEFAULT_URL, key_file=privkeyfile)
+    client = _get_client(DEFAULT_URL, privkeyfile)
     response = client.deleteDS(args.projectID, args.DS)
     print("delete Response: {}".format(response))
 
-def read_from_file(args):
-    command_file = open(args.filepath, 'r')
-    while True:
-        # Get next line from file
-        line = command_file.readline()
-        if not line:
-            break
-        line_args = line.split()
-        parser = create_parser(os.path.basename(sys.argv[0]))
-        line_args = parser.parse_args(line_args)
-        function_dispatcher(line_args)
-    command_file.close()
+def _command_lines(command_file):
+    '''Yield the lines of an open (binary) command file as str.
+
+       Files above MMAP_THRESHOLD are mapped and scanned in place rather
+       than read through the buffered file object.
+    '''
+    if os.fstat(command_file.fileno()).st_size > MMAP_THRESHOLD:
+        with mmap.mmap(command_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mapped:
+            for line in iter(mapped.readline, b''):
+                yield line.decode()
+    else:
+        for line in command_file:
+            yield line.decode()
 
-def auto_run():
+def read_from_file(args):
+    '''Run every command in args.filepath, one command line per line.
+
+       Blank lines and lines starting with '#' are skipped; arguments are
+       split with shell quoting rules.
+    '''
+    with open(args.filepath, 'rb') as command_file:
+        for line in _command_lines(command_file):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            function_dispatcher(parse_command(shlex.split(line)))
+
+def auto_run(args):
     micro_conversion = 1000000
-    time_interval = 1.0 / 20 * micro_conversion
-    print("interval is:" + str(time_interval))
-    processes = []
-    x = 1
-    # args_list = ["register","--feasibility true --ethicality true --approved_time 03.11.2022 --validity_duration 03.12.2022 --legal_base 1 --DS_selection_criteria GREEN --project_issuer salar1"]
-    args_list = ["reply PR11111112 --username DS", " yes"]
-    while x < 10000:
-        start_time = datetime.datetime.now()
-        proj_id = []
-        for i in range(0,10):
-            proj_id.append(str(random.randint(0, 9)))
-        arg = args_list[0] + format(x, '08d') + " " + args_list[1]
-        line_args = arg.split()
-        parser = create_parser(os.path.basename(sys.argv[0]))
-        line_args = parser.parse_args(line_args)
-
-        #function_dispatcher(line_args)
-        processes.append(Process(target=function_dispatcher, args=(line_args,)))
-        processes[-1].start()
-
-        end_time = datetime.datetime.now()
-        time_difference = end_time - start_time
-        print(time_difference.microseconds)
-        if(time_interval < time_difference.microseconds):
-            while True:
-                print("Incoming Throughput could not be reached!")
-                print(x)
+    target_tps = 20
+    # One POST carries AUTO_RUN_BATCH_SIZE replies, so that is the unit
+    # the target rate is paced and checked against.
+    time_interval = AUTO_RUN_BATCH_SIZE / target_tps * micro_conversion
+    LOGGER.debug("interval is: %s", time_interval)
+    # Workers are forked once up front; each batch is just a task handed
+    # to an already running process.
+    workers = os.cpu_count() or 1
+    pool = multiprocessing.get_context('fork').Pool(processes=workers,
+                                                    initializer=_init_worker)
+    inflight = deque()
+    for first in range(1, 10000, AUTO_RUN_BATCH_SIZE):
+        start_time = time.perf_counter()
+        usernames = ['DS' + format(x, '08d')
+                     for x in range(first, min(first + AUTO_RUN_BATCH_SIZE, 10000))]
+        inflight.append(pool.apply_async(_auto_reply, (usernames,)))
+        _reap_finished(inflight, AUTO_RUN_MAX_INFLIGHT)
+
+        elapsed_us = (time.perf_counter() - start_time) * micro_conversion
+        if(time_interval < elapsed_us):
+            LOGGER.warning("Incoming throughput %d TPS not reachable at tx %d",
+                           target_tps, first)
             break
-        print("time differene is (microSecs):")
-        print(time_interval - time_difference.microseconds)
-
-        print(x)
-        x = x+1
-
-
-
-        time.sleep((time_interval - time_difference.microseconds)/micro_conversion)
+        LOGGER.debug("batch at tx %d took %d us, %d us left in the interval",
+                     first, elapsed_us, time_interval - elapsed_us)
+
+        time.sleep(max(0, (time_interval - elapsed_us) / micro_conversion))
+
+    _reap_finished(inflight, 0)
+    pool.close()
+    pool.join()
+
+def _auto_reply(usernames):
+    '''Submit one auto_run consent reply per username in a single POST.
+
+       Inputs are fixed apart from the username; each reply is a batch
+       signed by its DS key and all of them travel in one BatchList. Every
+       DS key is used once, so only its signer is loaded; the batches are
+       built and sent through the worker's one keyless client and session.
+    '''
+    from smartmed_client import load_signer
+    client = _get_client(DEFAULT_URL, None)
+    batches = [client.reply_batch(AUTO_RUN_PROJECT, username, 'yes',
+                                  signer=load_signer(_get_private_keyfile(username)))
+               for username in usernames]
+    response = client.send_batches(batches, wait=10)
+    LOGGER.debug("auto_run response: %s", response)
+
+def _reap_finished(inflight, limit):
+    '''Drop finished auto_run tasks, waiting on the oldest beyond limit.
+
+       Keeps the deque of pending results bounded and reports tasks that
+       failed in a worker instead of silently dropping their errors.
+    '''
+    while inflight and (len(inflight) > limit or inflight[0].ready()):
+        result = inflight.popleft()
+        try:
+            result.get()
+        except Exception as err:
+            LOGGER.error("auto_run transaction failed: %s", err)
 
 def out_throughput():
     global out_time
-    time = datetime.datetime.now()
-    delta = time - out_time
-    out_time = time
-    print("Time interval between two commited transactions are:")
-    print(delta.seconds)
-    print("Equivalent to: " + str(1.0/delta.seconds) + " TPS")
+    now = time.perf_counter()
+    delta = now - out_time
+    out_time = now
+    if delta > 0 and LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info("Time interval between two commited transactions is "
+                    "%s s, equivalent to %s TPS", delta, 1.0/delta)
     
 
+DISPATCH = {
+    'register': do_register,
+    'request': do_request,
+    'reply': do_reply,
+    'find': do_find,
+    'interested': do_interested,
+    'delete': do_delete,
+    'deleteDS': do_deleteDS,
+    'list': do_list,
+    'showDS': do_showDS,
+    'showPR': do_showPR,
+    'auto_run': auto_run,
+    'file': read_from_file,
+}
+
 def function_dispatcher(args):
-    if args.command == 'register':
-        do_register(args)
-    elif args.command == 'request':
-        do_request(args)
-    elif args.command == 'reply':
-        do_reply(args)        
-    elif args.command == 'find':
-        do_find(args)
-    elif args.command == 'interested':
-        do_interested(args)
-    elif args.command == 'delete':
-        do_delete(args)
-    elif args.command == 'deleteDS':
-        do_deleteDS(args)            
-    elif args.command == 'list':
-        do_list()
-    elif args.command == 'showDS':
-        do_showDS(args)
-    elif args.command == 'showPR':
-        do_showPR(args)        
-    elif args.command == 'auto_run':
-        auto_run()
-    elif args.command == 'file':
-        read_from_file(args)                   	
-    else:
-        raise Exception("Invalid command: {}".format(args.command))
+    args.func(args)
 
 
-def main(prog_name=os.path.basename(sys.argv[0]), args=None):
+def main(prog_name=_PROG, args=None):
     '''Entry point function for the client CLI.'''
     try:
         if args is None:
             args = sys.argv[1:]
-        parser = create_parser(prog_name)
-        args = parser.parse_args(args)
-        verbose_level = 0
-        setup_loggers(verbose_level=verbose_level)
+        args = parse_command(args, prog_name)
+        setup_loggers(verbose_level=args.verbose)
         function_dispatcher(args)
 
     except KeyboardInterrupt:
         pass
     except SystemExit as err:
         raise err
-    except BaseException as err:
-        traceback.print_exc(file=sys.stderr)
+    except Exception as err:
+        # Errors raised by this CLI carry their own message; the full
+        # traceback is only worth formatting when debugging (-vv).
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.exception("Error: %s", err)
+        else:
+            LOGGER.error("Error: %s", err)
+        sys.exit(1)
+    except BaseException:
+        LOGGER.exception("Unexpected error")
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -16,14 +16,19 @@
 smartmedTransactionHandler class interfaces for smartmed Transaction Family.
 '''
 
+import atexit
 import traceback
 import sys
+import functools
 import hashlib
 import logging
 import random
 import string
 import os.path
 import json
+import threading
+
+import cbor
 
 from sawtooth_sdk.processor.handler import TransactionHandler
 from sawtooth_sdk.processor.exceptions import InvalidTransaction
@@ -31,6 +36,7 @@ from sawtooth_sdk.processor.exceptions import InternalError
 from sawtooth_sdk.processor.core import TransactionProcessor
 from pathlib import Path
 from collections import ChainMap
+from collections import namedtuple
 
 # hard-coded for simplicity (otherwise get the URL from the args in main):
 DEFAULT_URL = 'tcp://localhost:4004'
@@ -43,28 +49,77 @@ FAMILY_NAME = "smartmed"
 # TF Prefix is first 6 characters of SHA-512("smartmed"), a4d219
 
 def _hash(data):
-    '''Compute the SHA-512 hash and return the result as hex characters.'''
-    return hashlib.sha512(data).hexdigest()
+    '''Compute the SHA-512 hash and return the raw digest bytes.'''
+    return hashlib.sha512(data).digest()
+
+@functools.lru_cache(maxsize=4096)
+def _hash_prefix6(data):
+    '''Return the first 6 hex characters of SHA-512(data).
+
+       Only the bytes that are kept get hex-encoded, instead of encoding
+       all 128 hex characters and slicing. Memoized, since the same project
+       IDs are hashed again for every transaction that touches them.
+    '''
+    return _hash(data)[:3].hex()
+
+@functools.lru_cache(maxsize=4096)
+def _hash_hex64(data):
+    '''Return the first 64 hex characters of SHA-512(data) (memoized).'''
+    return _hash(data)[:32].hex()
+
+# Data subject list (ID,color per line) shipped next to this module, and
+# the file "find" reports its matches to.
+DSLIST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "dslist.txt")
+DS_COLOR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "ds-color.txt")
+
+# "find" marks the query_result slot of each matching DS public key.
+_DS_SLOT = {"DS1Pubkey": 1, "DS2Pubkey": 2, "DS3Pubkey": 3,
+            "DS4Pubkey": 4, "DS5Pubkey": 5}
+
+# "interested" updates the query_result slot of the replying DS.
+_DS_USER_SLOT = {"ds1": 1, "ds2": 2, "ds3": 3, "ds4": 4, "ds5": 5}
+
+# Labels for the numeric legal base given to "register".
+_LEGAL_BASE = {"1": "consent", "2": "performance of interest",
+               "3": "legitimate interest", "4": "vital interest",
+               "5": "legal reguirement", "6": "public interest"}
+
+# A project record as stored in state: a CBOR array in this field order.
+ProjectState = namedtuple('ProjectState', (
+    'projectID', 'feasibility', 'ethicality', 'approved_time',
+    'validity_duration', 'legal_base', 'DS_selection_criteria',
+    'project_issuer', 'HD_transfer_proof', 'consent_reply'))
+
+# The TF namespace prefix is constant, so it is hashed once at import.
+NAMESPACE_PREFIX = _hash_prefix6(FAMILY_NAME.encode('utf-8'))
+
+# Address layout, shared with pyclient/smartmed_client.py:
+#   project/query: NAMESPACE_PREFIX + first 64 hex of SHA-512(projID)
+#   DS consent:    first 6 hex of SHA-512(projID) + first 64 hex of SHA-512(dsID)
+# Both halves stay SHA-512 (the Sawtooth convention for family prefixes);
+# switching to SHA-256 or BLAKE3 would move every existing entry and has to
+# be done in the client at the same time, under a new family version.
 
 def _get_smartmed_address(from_key,projID):
     '''
     Return the address of a smartmed object from the smartmed TF.
 
     The address is the first 6 hex characters from the hash SHA-512(TF name),
-    plus the result of the hash SHA-512(smartmed public key).
+    plus the first 64 hex characters of SHA-512(project ID).
     '''
-    return _hash(FAMILY_NAME.encode('utf-8'))[0:6] + \
-                 _hash(projID.encode('utf-8'))[0:64] 
+    return NAMESPACE_PREFIX + _hash_hex64(projID.encode('utf-8'))
 
 def _get_DS_address(from_key,projID,dsID):
     '''
     Return the address of a project's consent object from the smartmed TF.
 
-    The address is the first 6 hex characters from the hash SHA-512(TF name),
-    plus the result of the hash SHA-512(smartmed public key).
+    The address is the first 6 hex characters from the hash SHA-512(project
+    ID), plus the first 64 hex characters of SHA-512(DS ID).
     '''
-    return _hash(projID.encode('utf-8'))[0:6] + \
-                 _hash(dsID.encode('utf-8'))[0:64]                                  
+    return _hash_prefix6(projID.encode('utf-8')) + \
+                 _hash_hex64(dsID.encode('utf-8'))                                  
 
 class smartmedTransactionHandler(TransactionHandler):
     '''
@@ -73,12 +128,52 @@ class smartmedTransactionHandler(TransactionHandler):
     This TP communicates with the Validator using the accept/get/set functions
     This implements functions to "find".
     '''
+    # action -> (payload field count including the action, handler name)
+    _ACTIONS = {
+        "register": (9, "_make_register"),
+        "request": (3, "_make_request"),
+        "reply": (4, "_make_reply"),
+        "find": (3, "_make_find"),
+        "interested": (9, "_make_interested"),
+        "delete": (2, "_make_delete"),
+        "deleteDS": (3, "_make_deleteDS"),
+    }
+
     def __init__(self, namespace_prefix):
         '''Initialize the transaction handler class.
 
            This is setting the "smartmed" TF namespace prefix.
         '''
         self._namespace_prefix = namespace_prefix
+        self._load_dslist(DSLIST_FILE)
+        # "find" appends its matches through one handle kept for the
+        # lifetime of the handler instead of reopening the file every time.
+        self._ds_color_fp = open(DS_COLOR_FILE, "a")
+        self._ds_color_lock = threading.Lock()
+        atexit.register(self._ds_color_fp.close)
+        # Resolve the handler of each action once, not on every apply().
+        self._handlers = {action: (n, getattr(self, name))
+                          for action, (n, name) in self._ACTIONS.items()}
+
+    def _load_dslist(self, path):
+        '''Parse the data subject list once for the lifetime of the handler.
+
+           _ds_rows keeps the rows that have the DS key and color columns
+           "find" reads (ID,key,color); _ds_by_color maps the casefolded
+           second column to the DS IDs with that value (for "request"). The file is read once at startup, so transactions
+           never touch it and there is nothing for mmap to save.
+        '''
+        self._ds_rows = []
+        self._ds_by_color = {}
+        with open(path, "r") as fr:
+            for line in fr:
+                data = line.strip().split(",")
+                if len(data) < 2:
+                    continue
+                if len(data) > 2:
+                    self._ds_rows.append(data)
+                self._ds_by_color.setdefault(data[1].casefold(), []) \
+                    .append(data[0])
 
     @property
     def family_name(self):
@@ -100,257 +195,181 @@ class smartmedTransactionHandler(TransactionHandler):
 
            The apply function does most of the work for this class by
            processing a transaction for the smartmed transaction family.
+           Each _make_* handler returns the (updates, deletes) it wants, and
+           they are written with a single set_state/delete_state call.
+
+           A transaction seen before must still be applied in full: the
+           validator re-runs transactions against other contexts (forks,
+           block re-validation), and skipping the state I/O there would
+           record an empty state change for it.
         '''
 
         # Get the payload and extract the smartmed-specific information.
         # It has already been converted from Base64, but needs deserializing.
         # It was serialized with CSV: action, value
         header = transaction.header
-        payload_list = transaction.payload.decode().split(",")
-        action = payload_list[0]
-        if action == "register":
-            projectID = payload_list[1]
-            feasibility = payload_list[2]
-            ethicality = payload_list[3]
-            approved_time = payload_list[4]
-            validity_duration = payload_list[5]
-            legal_base = payload_list[6]
-            DS_selection_criteria = payload_list[7]
-            project_issuer = payload_list[8]
-        elif action == "request":
-            projectID = payload_list[1]
-            username = payload_list[2]
-        elif action == "reply":
-            projectID = payload_list[1]
-            username = payload_list[2]
-            consent = payload_list[3]         
-        elif action == "find":
-            amount = payload_list[1]
-            qid = payload_list[2]
-        elif action == "interested":
-            username = payload_list[1]
-            qid = payload_list[2]
-            status = payload_list[3]
-            ds1 = payload_list[4]
-            ds2 = payload_list[5]
-            ds3 = payload_list[6]
-            ds4 = payload_list[7]
-            ds5 = payload_list[8]
-        elif action == "delete":
-            projectID = payload_list[1]
-        elif action == "deleteDS":
-            projectID = payload_list[1]
-            dsID = payload_list[2]     
+        action, handler, args = self._parse_payload(transaction.payload)
+        if handler is None:
+            LOGGER.info("Unhandled action. Action should be register or request or reply or delete or deleteDS")
+            return
 
         # Get the signer's public key, sent in the header from the client.
         from_key = header.signer_public_key
 
         # Perform the action.
-        if action == "register":
-            LOGGER.info("ProjectID = %s.", projectID)   
-            LOGGER.info("feasibility = %s.", feasibility)
-            LOGGER.info("ethicality = %s.", ethicality)
-            LOGGER.info("approved time= %s.", approved_time)
-            LOGGER.info("validity duration = %s.", validity_duration)
-            LOGGER.info("legal base = %s.", legal_base)
-            LOGGER.info("DS selection criteria = %s.", DS_selection_criteria)
-            LOGGER.info("project issuer = %s.", project_issuer)
-            self._make_register(context, projectID, feasibility, ethicality, approved_time, validity_duration,
-            legal_base, DS_selection_criteria, project_issuer, from_key)
-        elif action == "request":
-            LOGGER.info("ProjectID = %s.", projectID)   
-            LOGGER.info("username = %s.", username)
-            self._make_request(context, projectID, username, from_key)
-        elif action == "reply":
-            LOGGER.info("ProjectID = %s.", projectID)   
-            LOGGER.info("username = %s.", username)
-            LOGGER.info("consent = %s.", consent)
-            self._make_reply(context, projectID, username, consent, from_key)        
-        elif action == "find":
-            LOGGER.info("Amount = %s.", amount)   
-            LOGGER.info("Query ID = %s.", qid)
-            self._make_find(context, amount, qid, from_key)
-        elif action == "interested":
-            LOGGER.info("Username = %s.", username)        
-            LOGGER.info("Query ID = %s.", qid)
-            LOGGER.info("status = %s.", status)
-            LOGGER.info("ds1 = %s.", ds1)
-            LOGGER.info("ds2 = %s.", ds2)
-            LOGGER.info("ds3 = %s.", ds3)
-            LOGGER.info("ds4 = %s.", ds4)
-            LOGGER.info("ds5 = %s.", ds5)
-            self._make_interested(context, username, qid, status, ds1, ds2, ds3, ds4, ds5, from_key)            
-        elif action == "delete":
-            LOGGER.info("Query ID = %s.", projectID)
-            self._make_delete(context, projectID, from_key)
-        elif action == "deleteDS":
-            LOGGER.info("Project ID = %s.", projectID)
-            LOGGER.info("DS ID = %s.", dsID)
-            self._make_deleteDS(context, projectID, dsID, from_key)    
-        else:
-            LOGGER.info("Unhandled action. Action should be register or request or reply or delete or deleteDS")
-
-    @classmethod
-    def _make_register(cls, context, projectID, feasibility, ethicality, approved_time, validity_duration,
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("%s: %s", action, args)
+        updates, deletes = handler(context, *args, from_key)
+
+        # Write back everything the handler produced in one round trip each.
+        if updates:
+            addresses = context.set_state(updates)
+            if len(addresses) < len(updates):
+                raise InternalError("State Error")
+        if deletes:
+            context.delete_state(deletes)
+
+    def _parse_payload(self, payload):
+        '''Split a CSV payload into (action, handler, handler arguments).
+
+           This is the pure, state-free part of apply(). handler is None for
+           an unknown action; a known action with too few fields is invalid.
+        '''
+        # One decode of the whole payload is cheaper than splitting the bytes
+        # and decoding each field: every action uses all of its fields.
+        payload_list = payload.decode().split(",")
+        action = payload_list[0]
+        entry = self._handlers.get(action)
+        if entry is None:
+            return action, None, ()
+        n, handler = entry
+        if len(payload_list) < n:
+            raise InvalidTransaction(
+                "Malformed {} payload: expected {} fields, got {}".format(
+                    action, n - 1, len(payload_list) - 1))
+        return action, handler, payload_list[1:n]
+
+    @staticmethod
+    def _make_register(context, projectID, feasibility, ethicality, approved_time, validity_duration,
             legal_base, DS_selection_criteria, project_issuer, from_key):
         '''populate the ledger with project ID and instances.'''
         project_address = _get_smartmed_address(from_key,projectID)
-        LOGGER.info('Got the key %s and the project address %s.',
-                    from_key, project_address)
-        if legal_base == "1":
-            legal_base = "consent"
-        elif legal_base == "2":
-            legal_base = "performance of interest"
-        elif legal_base == "3":
-            legal_base = "legitimate interest"
-        elif legal_base == "4":
-            legal_base = "vital interest"
-        elif legal_base == "5":
-            legal_base = "legal reguirement"
-        elif legal_base == "6":
-            legal_base = "public interest"                         
-        project = [projectID,feasibility,ethicality,approved_time,validity_duration,legal_base,
-        DS_selection_criteria,project_issuer,"n/a",[]]
-        state_data = str(project).encode('utf-8')
-        addresses = context.set_state({project_address: state_data})
-
-    @classmethod
-    def _make_request(cls, context, projectID, username, from_key):
+        LOGGER.debug('Got the key %s and the project address %s.',
+                     from_key, project_address)
+        legal_base = _LEGAL_BASE.get(legal_base, legal_base)
+        project = ProjectState(projectID,feasibility,ethicality,approved_time,validity_duration,legal_base,
+            DS_selection_criteria,project_issuer,"n/a",[])
+        state_data = cbor.dumps(project)
+        return {project_address: state_data}, ()
+
+    def _make_request(self, context, projectID, username, from_key):
         '''find associated DSs to the project.'''
         query_address = _get_smartmed_address(from_key,projectID)
-        LOGGER.info('Got the key %s and the query address %s.',
-                    from_key, query_address)
+        LOGGER.debug('Got the key %s and the query address %s.',
+                     from_key, query_address)
         state_entries = context.get_state([query_address])
-        projectID,feasibility,ethicality,approved_time,validity_duration,legal_base, \
-        DS_selection_criteria,project_issuer,HD_transfer_proof,consent_reply \
-             = state_entries[0].data.decode().split(',')
-        LOGGER.info("project issuer = %s.", project_issuer.replace("'","").strip())    
-        if username == project_issuer.replace("'","").strip():
-            consent_reply = []
-            fr = open("dslist.txt","r")
-            lines = fr.readlines()
-            for line in lines:
-                data = line.strip().split(",")
-                if data[1].casefold() == DS_selection_criteria.replace("'","").strip():
-                    consent_reply.append(data[0])
-            fr.close()        
-            query_result = projectID,feasibility,ethicality,approved_time,validity_duration,legal_base, \
-                DS_selection_criteria,project_issuer,HD_transfer_proof,consent_reply
-            state_data = str(query_result).encode('utf-8')
-            addresses = context.set_state({query_address: state_data})
+        project = ProjectState(*cbor.loads(state_entries[0].data))
+        if username == project.project_issuer:
+            # dslist colors are keyed casefolded, so match "RED" and "red".
+            criterion = project.DS_selection_criteria.casefold()
+            project = project._replace(
+                consent_reply=list(self._ds_by_color.get(criterion, ())))
+            state_data = cbor.dumps(project)
+            return {query_address: state_data}, ()
         else:
             raise InternalError("Username Error")
 
-        if len(addresses) < 1:
-            raise InternalError("State Error")
-
-    @classmethod
-    def _make_reply(cls, context, projectID, username, consent, from_key):
+    @staticmethod
+    def _make_reply(context, projectID, username, consent, from_key):
         '''replying to consent.'''
         query_address = _get_smartmed_address(from_key,projectID)
-        LOGGER.info('Got the query address %s.', query_address)
+        LOGGER.debug('Got the query address %s.', query_address)
         state_entries = context.get_state([query_address])
-        projID,feasibility,ethicality,approved_time,validity_duration,legal_base, \
-        DS_selection_criteria,project_issuer,HD_transfer_proof,*DSs \
-             = state_entries[0].data.decode().split(',')
-        LOGGER.info("Reply from = %s. for project = %s", username, projectID)         
-        DS_found = False
-        count = -1
-        for ds in DSs:
-            count = count + 1
-            if ds.find(username) != -1:
-                DS_found = True
-                DS_address = _get_DS_address(from_key,projectID,username)
-                LOGGER.info('Got the DS address %s.', DS_address)
-                consent_result = projectID, username, consent
-                state_data = str(consent_result).encode('utf-8')
-                context.set_state({DS_address: state_data})
-        if DS_found == False:
-            raise InternalError("Username Error")    
-
-    @classmethod
-    def _make_find(cls, context, amount, qid, from_key):
+        project = ProjectState(*cbor.loads(state_entries[0].data))
+        LOGGER.debug("Reply from = %s. for project = %s", username, projectID)         
+        # A single exact lookup: scanning the decoded list beats building a
+        # set from it on every call.
+        if username not in project.consent_reply:
+            raise InternalError("Username Error")
+        DS_address = _get_DS_address(from_key,projectID,username)
+        LOGGER.debug('Got the DS address %s.', DS_address)
+        consent_result = [projectID, username, consent]
+        state_data = cbor.dumps(consent_result)
+        return {DS_address: state_data}, ()
+
+    def _make_find(self, context, amount, qid, from_key):
         '''find associated dsc from a specific dc based on the color tag.'''
         query_address = _get_smartmed_address(from_key,qid)
-        LOGGER.info('Got the key %s and the query address %s.',
-                    from_key, query_address)
+        LOGGER.debug('Got the key %s and the query address %s.',
+                     from_key, query_address)
+        if not self._ds_rows:
+            raise InvalidTransaction(
+                "find needs ID,key,color rows in {}".format(DSLIST_FILE))
         query_result = [qid,"n/a","n/a","n/a","n/a","n/a"]
-        fr = open("./pyprocessor/dslist.txt","r")
-        fw = open("./pyprocessor/ds-color.txt","w")
-        lines = fr.readlines()
-        for line in lines:
-            data = line.strip().split(",")
+        amount = amount.casefold()
+        matched = []
+        for data in self._ds_rows:
             if data[2].casefold() == amount:
-                if data[1] == "DS1Pubkey":
-                    query_result[1] = "waiting"                   
-                if data[1] == "DS2Pubkey":
-                    query_result[2] = "waiting"
-                if data[1] == "DS3Pubkey":
-                    query_result[3] = "waiting"
-                if data[1] == "DS4Pubkey":
-                    query_result[4] = "waiting"
-                if data[1] == "DS5Pubkey":
-                    query_result[5] = "waiting"            
-        fw.write(data[1])
-        fw.write("\n")               
-        fr.close()
-        fw.close()
-        state_data = str(query_result).encode('utf-8')
-        addresses = context.set_state({query_address: state_data})
-
-    def _make_interested(cls, context, username, qid, status, ds1, ds2, ds3, ds4, ds5, from_key):
+                slot = _DS_SLOT.get(data[1])
+                if slot is not None:
+                    query_result[slot] = "waiting"
+                    matched.append(data[1])
+        # Report every match of this query, not just the last row read.
+        if matched:
+            with self._ds_color_lock:
+                self._ds_color_fp.write("".join(ds + "\n" for ds in matched))
+                # Hand the lines to the OS now: atexit does not run when the
+                # container is stopped with SIGTERM.
+                self._ds_color_fp.flush()
+        state_data = cbor.dumps(query_result)
+        return {query_address: state_data}, ()
+
+    @staticmethod
+    def _make_interested(context, username, qid, status, ds1, ds2, ds3, ds4, ds5, from_key):
         '''Register the interest of a DS to a query.'''
         query_address = _get_smartmed_address(from_key,qid)
-        LOGGER.info('Got the key %s and the smartmed address %s.',
-                    from_key, query_address)
+        LOGGER.debug('Got the key %s and the smartmed address %s.',
+                     from_key, query_address)
         state_entries = context.get_state([query_address])
-        qid, ds1, ds2, ds3, ds4, ds5 = state_entries[0].data.decode().split(',')        
+        qid, ds1, ds2, ds3, ds4, ds5 = cbor.loads(state_entries[0].data)        
         if status == "yes":
             status = "inetersted"
         else:
             status = "not interested"    
-        if username == "ds1":
-            query_result = qid, status, ds2, ds3, ds4, ds5
-        if username == "ds2":
-            query_result = qid, ds1, status, ds3, ds4, ds5
-        if username == "ds3":
-            query_result = qid, ds1, ds2, status, ds4, ds5
-        if username == "ds4":
-            query_result = qid, ds1, ds2, ds3, status, ds5
-        if username == "ds5":
-            query_result = qid, ds1, ds2, ds3, ds4, status                
-        state_data = str(query_result).encode('utf-8')
-        addresses = context.set_state({query_address: state_data})
-
-        if len(addresses) < 1:
-            raise InternalError("State Error")
+        slot = _DS_USER_SLOT.get(username)
+        if slot is None:
+            raise InternalError("Username Error")
+        query_result = [qid, ds1, ds2, ds3, ds4, ds5]
+        query_result[slot] = status
+        state_data = cbor.dumps(query_result)
         context.add_event(
             event_type="smartmed/bake",
             attributes=[("cookies-baked", username)])    
+        return {query_address: state_data}, ()
 
-    @classmethod
-    def _make_delete(cls, context, projectID, from_key):
+    @staticmethod
+    def _make_delete(context, projectID, from_key):
         query_address = _get_smartmed_address(from_key,projectID)
-        LOGGER.info('Got the key %s and the query address %s.',
-                    from_key, query_address)
-        context.delete_state([query_address])
+        LOGGER.debug('Got the key %s and the query address %s.',
+                     from_key, query_address)
+        return {}, [query_address]
 
-    def _make_deleteDS(cls, context, projectID, dsID, from_key):
+    @staticmethod
+    def _make_deleteDS(context, projectID, dsID, from_key):
         projds_address = _get_DS_address(from_key, projectID, dsID)
-        LOGGER.info('Got the project-ds address %s.', projds_address)
-        context.delete_state([projds_address])   
+        LOGGER.debug('Got the project-ds address %s.', projds_address)
+        return {}, [projds_address]
 
 def main():
     '''Entry-point function for the smartmed Transaction Processor.'''
     try:
         # Setup logging for this class.
         logging.basicConfig()
-        logging.getLogger().setLevel(logging.DEBUG)
+        logging.getLogger().setLevel(logging.INFO)
 
         # Register the Transaction Handler and start it.
         processor = TransactionProcessor(url=DEFAULT_URL)
-        sw_namespace = _hash(FAMILY_NAME.encode('utf-8'))[0:6]
-        handler = smartmedTransactionHandler(sw_namespace)
+        handler = smartmedTransactionHandler(NAMESPACE_PREFIX)
         processor.add_handler(handler)
         processor.start()
     except KeyboardInterrupt: